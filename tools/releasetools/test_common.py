@@ -13,10 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import itertools
 import os
 import shutil
 import tempfile
-import time
 import unittest
 import zipfile
 
@@ -29,29 +29,79 @@ KiB = 1024
 MiB = 1024 * KiB
 GiB = 1024 * MiB
 
+# An opaque payload for the round-trip tests. Its contents don't matter, so a
+# single blob is generated (and hashed) once per run.
+RANDOM_1K = os.urandom(1 * KiB)
+RANDOM_1K_SHA1 = sha1(RANDOM_1K).hexdigest()
+
+# A run of zeros standing for a hole in the generated file. It is allocated
+# once and yielded repeatedly, so consumers can recognize it by identity.
+ZERO_HOLE = b'\0' * (4 * MiB - 4 * KiB)
+
 def get_2gb_string():
   size = int(2 * GiB + 1)
   block_size = 4 * KiB
-  step_size = 4 * MiB
+  step_size = block_size + len(ZERO_HOLE)
+  # Fetch the random data for all the steps at once, rather than making one
+  # os.urandom() call per step.
+  steps = (size + step_size - 1) // step_size
+  pool = memoryview(os.urandom(steps * block_size))
   # Generate a long string with holes, e.g. 'xyz\x00abc\x00...'.
-  for _ in range(0, size, step_size):
-    yield os.urandom(block_size)
-    yield '\0' * (step_size - block_size)
+  for offset in range(0, steps * block_size, block_size):
+    yield pool[offset:offset + block_size]
+    yield ZERO_HOLE
+
+
+def write_test_file(test_file, contents):
+  """Writes contents into test_file and returns the SHA-1 hex digest of it.
+
+  ZERO_HOLE chunks are skipped over rather than written, so the file ends up
+  sparse on filesystems that support it. They are still hashed.
+  """
+  sha1_hash = sha1()
+  for data in contents:
+    sha1_hash.update(data)
+    if data is ZERO_HOLE:
+      test_file.seek(len(data), os.SEEK_CUR)
+    else:
+      test_file.write(data)
+  # Extend the file to cover a trailing hole, if any.
+  test_file.truncate()
+  return sha1_hash.hexdigest()
+
+
+class HashSink(object):
+  """A write-only file-like object that feeds everything into a hash."""
+
+  def __init__(self, hash_obj):
+    self.hash_obj = hash_obj
+
+  def write(self, data):
+    self.hash_obj.update(data)
+    return len(data)
 
 
 class CommonZipTest(unittest.TestCase):
-  def _verify(self, zip_file, zip_file_name, arcname, expected_hash,
-              test_file_name=None, expected_stat=None, expected_mode=0o644,
-              expected_compress_type=zipfile.ZIP_STORED):
+  # Read size when hashing zip entries. It's kept around the L2 cache size so
+  # that each chunk is still cached when the hash consumes it.
+  _HASH_CHUNK_SIZE = 256 * KiB
+
+  def _verify(self, zip_file, arcname, expected_hash, test_file_name=None,
+              expected_stat=None, expected_mode=0o644,
+              expected_compress_type=zipfile.ZIP_STORED, verify_crc=True):
+    """Verifies an entry of zip_file, which must be opened for reading.
+
+    verify_crc controls the final testzip() pass, which rereads every entry in
+    the archive. Large-file tests skip it: the entry is hashed by reading it
+    through zip_file.open() to the end, and zipfile checks its CRC right there,
+    whatever its compress type.
+    """
     # Verify the stat if present.
     if test_file_name is not None:
       new_stat = os.stat(test_file_name)
       self.assertEqual(int(expected_stat.st_mode), int(new_stat.st_mode))
       self.assertEqual(int(expected_stat.st_mtime), int(new_stat.st_mtime))
 
-    # Reopen the zip file to verify.
-    zip_file = zipfile.ZipFile(zip_file_name, "r")
-
     # Verify the timestamp.
     info = zip_file.getinfo(arcname)
     self.assertEqual(info.date_time, (2009, 1, 1, 0, 0, 0))
@@ -64,92 +114,128 @@ class CommonZipTest(unittest.TestCase):
     self.assertEqual(info.compress_type, expected_compress_type)
 
     # Verify the zip contents.
-    entry = zip_file.open(arcname)
     sha1_hash = sha1()
-    for chunk in iter(lambda: entry.read(4 * MiB), ''):
-      sha1_hash.update(chunk)
+    shutil.copyfileobj(zip_file.open(arcname), HashSink(sha1_hash),
+                       self._HASH_CHUNK_SIZE)
     self.assertEqual(expected_hash, sha1_hash.hexdigest())
-    self.assertIsNone(zip_file.testzip())
+    if verify_crc:
+      self.assertIsNone(zip_file.testzip())
+
+  # The name and SHA-1 of the large test file shared by the class.
+  _large_file = None
+
+  @classmethod
+  def setUpClass(cls):
+    # All the temp files of the class live here, and go away in one go.
+    cls._tempdir = tempfile.mkdtemp()
+    cls._temp_counter = itertools.count()
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls._tempdir)
+    cls._large_file = None
+
+  @classmethod
+  def _temp_path(cls, prefix):
+    return os.path.join(cls._tempdir,
+                        "%s_%d" % (prefix, next(cls._temp_counter)))
+
+  @classmethod
+  def _get_large_file(cls):
+    """Returns the name and SHA-1 of a ~2GiB test file.
+
+    The file is generated on first use and shared by all the large-file tests,
+    so running only the small tests doesn't pay for it.
+    """
+    if cls._large_file is None:
+      test_file_name = cls._temp_path("large")
+      with open(test_file_name, "wb") as test_file:
+        expected_hash = write_test_file(test_file, get_2gb_string())
+      cls._large_file = (test_file_name, expected_hash)
+    return cls._large_file
+
+  @staticmethod
+  def _backdate(test_file_name):
+    """Moves the atime/mtime of test_file_name into the past.
+
+    This way ZipWrite() failing to restore them can't go unnoticed behind the
+    current timestamp. Returns the new os.stat() of the file.
+    """
+    stat = os.stat(test_file_name)
+    os.utime(test_file_name, (stat.st_atime - 10, stat.st_mtime - 10))
+    return os.stat(test_file_name)
 
   def _test_ZipWrite(self, contents, extra_zipwrite_args=None):
-    extra_zipwrite_args = dict(extra_zipwrite_args or {})
+    test_file_name = self._temp_path("test")
+    with open(test_file_name, "wb") as test_file:
+      expected_hash = write_test_file(test_file, contents)
 
-    test_file = tempfile.NamedTemporaryFile(delete=False)
-    test_file_name = test_file.name
+    self._test_ZipWrite_file(test_file_name, expected_hash,
+                             extra_zipwrite_args)
 
-    zip_file = tempfile.NamedTemporaryFile(delete=False)
-    zip_file_name = zip_file.name
+  def _test_ZipWrite_file(self, test_file_name, expected_hash,
+                          extra_zipwrite_args=None, verify_crc=True):
+    extra_zipwrite_args = dict(extra_zipwrite_args or {})
+
+    zip_file_name = self._temp_path("zip")
 
     # File names within an archive strip the leading slash.
     arcname = extra_zipwrite_args.get("arcname", test_file_name)
     if arcname[0] == "/":
       arcname = arcname[1:]
 
-    zip_file.close()
     zip_file = zipfile.ZipFile(zip_file_name, "w")
 
-    try:
-      sha1_hash = sha1()
-      for data in contents:
-        sha1_hash.update(data)
-        test_file.write(data)
-      test_file.close()
-
-      expected_stat = os.stat(test_file_name)
-      expected_mode = extra_zipwrite_args.get("perms", 0o644)
-      expected_compress_type = extra_zipwrite_args.get("compress_type",
-                                                       zipfile.ZIP_STORED)
-      time.sleep(5)  # Make sure the atime/mtime will change measurably.
-
-      common.ZipWrite(zip_file, test_file_name, **extra_zipwrite_args)
-      common.ZipClose(zip_file)
-
-      self._verify(zip_file, zip_file_name, arcname, sha1_hash.hexdigest(),
-                   test_file_name, expected_stat, expected_mode,
-                   expected_compress_type)
-    finally:
-      os.remove(test_file_name)
-      os.remove(zip_file_name)
-
-  def _test_ZipWriteStr(self, zinfo_or_arcname, contents, extra_args=None):
-    extra_args = dict(extra_args or {})
+    expected_stat = self._backdate(test_file_name)
+    expected_mode = extra_zipwrite_args.get("perms", 0o644)
+    expected_compress_type = extra_zipwrite_args.get("compress_type",
+                                                     zipfile.ZIP_STORED)
 
-    zip_file = tempfile.NamedTemporaryFile(delete=False)
-    zip_file_name = zip_file.name
-    zip_file.close()
+    common.ZipWrite(zip_file, test_file_name, **extra_zipwrite_args)
+    common.ZipClose(zip_file)
 
-    zip_file = zipfile.ZipFile(zip_file_name, "w")
+    with zipfile.ZipFile(zip_file_name, "r") as zip_file:
+      self._verify(zip_file, arcname, expected_hash, test_file_name,
+                   expected_stat, expected_mode, expected_compress_type,
+                   verify_crc)
+
+  def _run_ZipWriteStr(self, zinfo_or_arcname, arcname, contents,
+                       expected_mode, extra_args):
+    zip_file_name = self._temp_path("zip")
 
-    try:
-      expected_compress_type = extra_args.get("compress_type",
-                                              zipfile.ZIP_STORED)
-      time.sleep(5)  # Make sure the atime/mtime will change measurably.
+    zip_file = zipfile.ZipFile(zip_file_name, "w")
 
-      if not isinstance(zinfo_or_arcname, zipfile.ZipInfo):
-        arcname = zinfo_or_arcname
-        expected_mode = extra_args.get("perms", 0o644)
-      else:
-        arcname = zinfo_or_arcname.filename
-        expected_mode = extra_args.get("perms",
-                                       zinfo_or_arcname.external_attr >> 16)
+    expected_compress_type = extra_args.get("compress_type",
+                                            zipfile.ZIP_STORED)
 
-      common.ZipWriteStr(zip_file, zinfo_or_arcname, contents, **extra_args)
-      common.ZipClose(zip_file)
+    common.ZipWriteStr(zip_file, zinfo_or_arcname, contents, **extra_args)
+    common.ZipClose(zip_file)
 
-      self._verify(zip_file, zip_file_name, arcname, sha1(contents).hexdigest(),
+    expected_hash = sha1(contents).hexdigest()
+    with zipfile.ZipFile(zip_file_name, "r") as zip_file:
+      self._verify(zip_file, arcname, expected_hash,
                    expected_mode=expected_mode,
                    expected_compress_type=expected_compress_type)
-    finally:
-      os.remove(zip_file_name)
 
-  def _test_ZipWriteStr_large_file(self, large, small, extra_args=None):
+  def _test_ZipWriteStr_arcname(self, arcname, contents, extra_args=None):
+    extra_args = dict(extra_args or {})
+    expected_mode = extra_args.get("perms", 0o644)
+    self._run_ZipWriteStr(arcname, arcname, contents, expected_mode,
+                          extra_args)
+
+  def _test_ZipWriteStr_zinfo(self, zinfo, contents, extra_args=None):
+    extra_args = dict(extra_args or {})
+    # Read the mode before ZipWriteStr() gets a chance to update zinfo.
+    expected_mode = extra_args.get("perms", zinfo.external_attr >> 16)
+    self._run_ZipWriteStr(zinfo, zinfo.filename, contents, expected_mode,
+                          extra_args)
+
+  def _test_ZipWriteStr_large_file(self, small, extra_args=None):
     extra_args = dict(extra_args or {})
 
-    zip_file = tempfile.NamedTemporaryFile(delete=False)
-    zip_file_name = zip_file.name
+    zip_file_name = self._temp_path("zip")
 
-    test_file = tempfile.NamedTemporaryFile(delete=False)
-    test_file_name = test_file.name
+    test_file_name, large_hash = self._get_large_file()
 
     arcname_large = test_file_name
     arcname_small = "bar"
@@ -158,38 +244,27 @@ class CommonZipTest(unittest.TestCase):
     if arcname_large[0] == "/":
       arcname_large = arcname_large[1:]
 
-    zip_file.close()
     zip_file = zipfile.ZipFile(zip_file_name, "w")
 
-    try:
-      sha1_hash = sha1()
-      for data in large:
-        sha1_hash.update(data)
-        test_file.write(data)
-      test_file.close()
+    expected_stat = self._backdate(test_file_name)
+    expected_mode = 0o644
+    expected_compress_type = extra_args.get("compress_type",
+                                            zipfile.ZIP_STORED)
 
-      expected_stat = os.stat(test_file_name)
-      expected_mode = 0o644
-      expected_compress_type = extra_args.get("compress_type",
-                                              zipfile.ZIP_STORED)
-      time.sleep(5)  # Make sure the atime/mtime will change measurably.
-
-      common.ZipWrite(zip_file, test_file_name, **extra_args)
-      common.ZipWriteStr(zip_file, arcname_small, small, **extra_args)
-      common.ZipClose(zip_file)
+    common.ZipWrite(zip_file, test_file_name, **extra_args)
+    common.ZipWriteStr(zip_file, arcname_small, small, **extra_args)
+    common.ZipClose(zip_file)
 
+    with zipfile.ZipFile(zip_file_name, "r") as zip_file:
       # Verify the contents written by ZipWrite().
-      self._verify(zip_file, zip_file_name, arcname_large,
-                   sha1_hash.hexdigest(), test_file_name, expected_stat,
-                   expected_mode, expected_compress_type)
+      self._verify(zip_file, arcname_large, large_hash, test_file_name,
+                   expected_stat, expected_mode, expected_compress_type,
+                   verify_crc=False)
 
       # Verify the contents written by ZipWriteStr().
-      self._verify(zip_file, zip_file_name, arcname_small,
-                   sha1(small).hexdigest(),
-                   expected_compress_type=expected_compress_type)
-    finally:
-      os.remove(zip_file_name)
-      os.remove(test_file_name)
+      self._verify(zip_file, arcname_small, sha1(small).hexdigest(),
+                   expected_compress_type=expected_compress_type,
+                   verify_crc=False)
 
   def _test_reset_ZIP64_LIMIT(self, func, *args):
     default_limit = (1 << 31) - 1
@@ -198,61 +273,57 @@ class CommonZipTest(unittest.TestCase):
     self.assertEqual(default_limit, zipfile.ZIP64_LIMIT)
 
   def test_ZipWrite(self):
-    file_contents = os.urandom(1024)
-    self._test_ZipWrite(file_contents)
+    self._test_ZipWrite(RANDOM_1K)
 
   def test_ZipWrite_with_opts(self):
-    file_contents = os.urandom(1024)
-    self._test_ZipWrite(file_contents, {
+    self._test_ZipWrite(RANDOM_1K, {
         "arcname": "foobar",
         "perms": 0o777,
         "compress_type": zipfile.ZIP_DEFLATED,
     })
-    self._test_ZipWrite(file_contents, {
+    self._test_ZipWrite(RANDOM_1K, {
         "arcname": "foobar",
         "perms": 0o700,
         "compress_type": zipfile.ZIP_STORED,
     })
 
   def test_ZipWrite_large_file(self):
-    file_contents = get_2gb_string()
-    self._test_ZipWrite(file_contents, {
+    test_file_name, expected_hash = self._get_large_file()
+    self._test_ZipWrite_file(test_file_name, expected_hash, {
         "compress_type": zipfile.ZIP_DEFLATED,
-    })
+    }, verify_crc=False)
 
   def test_ZipWrite_resets_ZIP64_LIMIT(self):
     self._test_reset_ZIP64_LIMIT(self._test_ZipWrite, "")
 
   def test_ZipWriteStr(self):
-    random_string = os.urandom(1024)
     # Passing arcname
-    self._test_ZipWriteStr("foo", random_string)
+    self._test_ZipWriteStr_arcname("foo", RANDOM_1K)
 
     # Passing zinfo
     zinfo = zipfile.ZipInfo(filename="foo")
-    self._test_ZipWriteStr(zinfo, random_string)
+    self._test_ZipWriteStr_zinfo(zinfo, RANDOM_1K)
 
     # Timestamp in the zinfo should be overwritten.
     zinfo.date_time = (2015, 3, 1, 15, 30, 0)
-    self._test_ZipWriteStr(zinfo, random_string)
+    self._test_ZipWriteStr_zinfo(zinfo, RANDOM_1K)
 
   def test_ZipWriteStr_with_opts(self):
-    random_string = os.urandom(1024)
     # Passing arcname
-    self._test_ZipWriteStr("foo", random_string, {
+    self._test_ZipWriteStr_arcname("foo", RANDOM_1K, {
         "perms": 0o700,
         "compress_type": zipfile.ZIP_DEFLATED,
     })
-    self._test_ZipWriteStr("bar", random_string, {
+    self._test_ZipWriteStr_arcname("bar", RANDOM_1K, {
         "compress_type": zipfile.ZIP_STORED,
     })
 
     # Passing zinfo
     zinfo = zipfile.ZipInfo(filename="foo")
-    self._test_ZipWriteStr(zinfo, random_string, {
+    self._test_ZipWriteStr_zinfo(zinfo, RANDOM_1K, {
         "compress_type": zipfile.ZIP_DEFLATED,
     })
-    self._test_ZipWriteStr(zinfo, random_string, {
+    self._test_ZipWriteStr_zinfo(zinfo, RANDOM_1K, {
         "perms": 0o600,
         "compress_type": zipfile.ZIP_STORED,
     })
@@ -261,59 +332,53 @@ class CommonZipTest(unittest.TestCase):
     # zipfile.writestr() doesn't work when the str size is over 2GiB even with
     # the workaround. We will only test the case of writing a string into a
     # large archive.
-    long_string = get_2gb_string()
-    short_string = os.urandom(1024)
-    self._test_ZipWriteStr_large_file(long_string, short_string, {
+    self._test_ZipWriteStr_large_file(RANDOM_1K, {
         "compress_type": zipfile.ZIP_DEFLATED,
     })
 
   def test_ZipWriteStr_resets_ZIP64_LIMIT(self):
-    self._test_reset_ZIP64_LIMIT(self._test_ZipWriteStr, "foo", "")
+    self._test_reset_ZIP64_LIMIT(self._test_ZipWriteStr_arcname, "foo", "")
     zinfo = zipfile.ZipInfo(filename="foo")
-    self._test_reset_ZIP64_LIMIT(self._test_ZipWriteStr, zinfo, "")
+    self._test_reset_ZIP64_LIMIT(self._test_ZipWriteStr_zinfo, zinfo, "")
 
   def test_bug21309935(self):
-    zip_file = tempfile.NamedTemporaryFile(delete=False)
-    zip_file_name = zip_file.name
-    zip_file.close()
-
-    try:
-      random_string = os.urandom(1024)
-      zip_file = zipfile.ZipFile(zip_file_name, "w")
-      # Default perms should be 0o644 when passing the filename.
-      common.ZipWriteStr(zip_file, "foo", random_string)
-      # Honor the specified perms.
-      common.ZipWriteStr(zip_file, "bar", random_string, perms=0o755)
-      # The perms in zinfo should be untouched.
-      zinfo = zipfile.ZipInfo(filename="baz")
-      zinfo.external_attr = 0o740 << 16
-      common.ZipWriteStr(zip_file, zinfo, random_string)
-      # Explicitly specified perms has the priority.
-      zinfo = zipfile.ZipInfo(filename="qux")
-      zinfo.external_attr = 0o700 << 16
-      common.ZipWriteStr(zip_file, zinfo, random_string, perms=0o400)
-      common.ZipClose(zip_file)
-
-      self._verify(zip_file, zip_file_name, "foo",
-                   sha1(random_string).hexdigest(),
-                   expected_mode=0o644)
-      self._verify(zip_file, zip_file_name, "bar",
-                   sha1(random_string).hexdigest(),
-                   expected_mode=0o755)
-      self._verify(zip_file, zip_file_name, "baz",
-                   sha1(random_string).hexdigest(),
-                   expected_mode=0o740)
-      self._verify(zip_file, zip_file_name, "qux",
-                   sha1(random_string).hexdigest(),
-                   expected_mode=0o400)
-    finally:
-      os.remove(zip_file_name)
+    zip_file_name = self._temp_path("zip")
+
+    zip_file = zipfile.ZipFile(zip_file_name, "w")
+    # Default perms should be 0o644 when passing the filename.
+    common.ZipWriteStr(zip_file, "foo", RANDOM_1K)
+    # Honor the specified perms.
+    common.ZipWriteStr(zip_file, "bar", RANDOM_1K, perms=0o755)
+    # The perms in zinfo should be untouched.
+    zinfo = zipfile.ZipInfo(filename="baz")
+    zinfo.external_attr = 0o740 << 16
+    common.ZipWriteStr(zip_file, zinfo, RANDOM_1K)
+    # Explicitly specified perms has the priority.
+    zinfo = zipfile.ZipInfo(filename="qux")
+    zinfo.external_attr = 0o700 << 16
+    common.ZipWriteStr(zip_file, zinfo, RANDOM_1K, perms=0o400)
+    common.ZipClose(zip_file)
+
+    with zipfile.ZipFile(zip_file_name, "r") as zip_file:
+      self._verify(zip_file, "foo", RANDOM_1K_SHA1, expected_mode=0o644)
+      self._verify(zip_file, "bar", RANDOM_1K_SHA1, expected_mode=0o755)
+      self._verify(zip_file, "baz", RANDOM_1K_SHA1, expected_mode=0o740)
+      self._verify(zip_file, "qux", RANDOM_1K_SHA1, expected_mode=0o400)
 
 class InstallRecoveryScriptFormatTest(unittest.TestCase):
   """Check the format of install-recovery.sh
 
   Its format should match between common.py and validate_target_files.py."""
 
+  # The gzipped recovery.img and boot.img, which stay the same for all tests.
+  # echo -n "recovery" | gzip -f | hd
+  recovery_data = (b"\x1f\x8b\x08\x00\x81\x11\x02\x5a\x00\x03\x2b\x4a"
+                   b"\x4d\xce\x2f\x4b\x2d\xaa\x04\x00\xc9\x93\x43\xf3"
+                   b"\x08\x00\x00\x00")
+  # echo -n "boot" | gzip -f | hd
+  boot_data = (b"\x1f\x8b\x08\x00\x8c\x12\x02\x5a\x00\x03\x4b\xca"
+               b"\xcf\x2f\x01\x00\xc4\xae\xed\x46\x04\x00\x00\x00")
+
   def setUp(self):
     self._tempdir = tempfile.mkdtemp()
     # Create a dummy dict that contains the fstab info for boot&recovery.
@@ -322,17 +387,6 @@ class InstallRecoveryScriptFormatTest(unittest.TestCase):
         ["/dev/soc.0/by-name/boot /boot emmc defaults defaults",
          "/dev/soc.0/by-name/recovery /recovery emmc defaults defaults"]
     self._info["fstab"] = common.LoadRecoveryFSTab("\n".join, 2, dummy_fstab)
-    # Construct the gzipped recovery.img and boot.img
-    self.recovery_data = bytearray([
-        0x1f, 0x8b, 0x08, 0x00, 0x81, 0x11, 0x02, 0x5a, 0x00, 0x03, 0x2b, 0x4a,
-        0x4d, 0xce, 0x2f, 0x4b, 0x2d, 0xaa, 0x04, 0x00, 0xc9, 0x93, 0x43, 0xf3,
-        0x08, 0x00, 0x00, 0x00
-    ])
-    # echo -n "boot" | gzip -f | hd
-    self.boot_data = bytearray([
-        0x1f, 0x8b, 0x08, 0x00, 0x8c, 0x12, 0x02, 0x5a, 0x00, 0x03, 0x4b, 0xca,
-        0xcf, 0x2f, 0x01, 0x00, 0xc4, 0xae, 0xed, 0x46, 0x04, 0x00, 0x00, 0x00
-    ])
 
   def _out_tmp_sink(self, name, data, prefix="SYSTEM"):
     loc = os.path.join(self._tempdir, prefix, name)